@@ -1,50 +1,203 @@
 import os
+import errno
+import functools
 import json
 import subprocess
 import logging
+import logging.handlers
+import queue
+import atexit
 import sys
 import time
 import signal
+import select
+import selectors
 import socket
 import re
+import shutil
+from urllib.parse import quote
+import threading
+import asyncio
+from dataclasses import dataclass
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # Configuration
 CAMERAS_CONFIG = '/etc/roc/cameras.json'
 LOG_DIR = '/var/log/cameras'
 ERROR_LOG = '/var/log/ffmpeg_errors.log'
 SETUP_SCRIPT = '/usr/local/bin/setup_v4l2loopback.sh'
+STATE_FILE = '/var/lib/roc/last_stream.json'  # Last working stream type per camera
 STREAM_TYPES = ['main', 'ext', 'sub']  # Order for quality preference
+STREAM_NUM = {'main': 0, 'ext': 0, 'sub': 1}  # RTMP stream= parameter per stream type
+STREAM_TYPE_INDEX = {t: i for i, t in enumerate(STREAM_TYPES)}
 TEST_TIMEOUT = 15  # Increased timeout for stream testing
 MAX_RETRIES = 12  # Increased retries (4 cycles through stream types)
+VIDEO_DEVICES_TTL = 10  # Seconds before the cached /dev listing is refreshed
+# Absolute path lets subprocess launch ffmpeg via posix_spawn instead of fork+exec
+FFMPEG_BIN = shutil.which('ffmpeg') or 'ffmpeg'
+
+# Fallback parsers for ffmpeg stderr when ffprobe is unavailable
+_RES_RE = re.compile(r'(\d+x\d+)')
+_FPS_RE = re.compile(r'(\d+\.?\d*) fps')
 
-# Setup logging
+# Error lines copied from camera logs to ERROR_LOG, matched on raw bytes
+_ERR_RE = re.compile(rb'(?i)error|failed|timeout|connection refused|input/output error|end of file')
+
+# Setup logging; records are queued and written by a background listener thread
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.FileHandler('/var/log/camera_streamer.log'),
+    logging.StreamHandler()  # Centralized console output
+)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/var/log/camera_streamer.log'),
-        logging.StreamHandler()  # Centralized console output
-    ]
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flush queued records on any exit path
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=4)
+def _load_cameras_cached(path, mtime_ns, size):
+    """Read and parse a camera config file, memoized on its mtime and size."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:3] == b'\xef\xbb\xbf':
+        data = data[3:]
+    data = data.strip()
+    if not data:
+        return None
+    logger.debug(f"First 10 bytes of {path}: {data[:10]!r}")
+    return _json_loads(data)
+
+@dataclass(slots=True, frozen=True)
+class Camera:
+    """Validated camera config entry with its precomputed RTMP URL template."""
+    ip: str
+    password: str
+    user: str = 'admin'
+    url_tmpl: str = ''
+
+@dataclass(slots=True)
+class ProcState:
+    """Running ffmpeg process for a camera plus its restart state."""
+    cam: Camera
+    proc: subprocess.Popen
+    fallback_index: int
+    retry_delay: float = 5
+    next_retry_at: float = 0.0
+    worker: threading.Thread | None = None
+    restarting: bool = False
+    pidfd: int | None = None
+    pidfd_failed_pid: int | None = None
+
 class CameraStreamer:
     def __init__(self):
-        self.processes = []
-        self.exit_flag = False
+        self.processes: dict[int, ProcState] = {}
+        self._stop = threading.Event()
+        self._probe_procs = set()  # In-flight probe subprocesses, killed on shutdown
+        self._err_fd = None
+        self._video_devices = frozenset()
+        self._video_devices_ts = None
+        self._last_streams = {}
+        self._state_lock = threading.Lock()
+        # Self-pipe woken by the C signal handler so the monitor loop can block
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        signal.set_wakeup_fd(self._wakeup_w, warn_on_full_buffer=False)
         signal.signal(signal.SIGINT, self._signal_handler)
         signal.signal(signal.SIGTERM, self._signal_handler)
+        # ffmpeg exits are watched through pidfds (Linux 5.3+); SIGCHLD is the fallback
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+            self._use_pidfd = True
+        except (AttributeError, OSError):
+            self._use_pidfd = False
+            signal.signal(signal.SIGCHLD, self._sigchld_handler)
 
     def _signal_handler(self, sig, frame):
         logger.info(f"Received signal {sig}. Shutting down...")
-        self.exit_flag = True
-        for _, _, proc, _ in self.processes:
-            if proc and proc.poll() is None:
-                proc.terminate()
+        self._stop.set()
+        self._kill_probes()
+        for state in self.processes.values():
+            if state.proc.poll() is None:
+                state.proc.terminate()
                 try:
-                    proc.wait(timeout=5)
+                    state.proc.wait(timeout=5)
                 except subprocess.TimeoutExpired:
-                    proc.kill()
+                    state.proc.kill()
+
+    def _sigchld_handler(self, sig, frame):
+        """Wake the monitor loop when a child exits; reaping happens there."""
+        # Reaping here would race with subprocess.run() in probe threads and
+        # with Popen's own waitpid lock, so exited children are polled only
+        # once the loop wakes up.
+
+    def _drain_wakeup(self):
+        """Empty the self-pipe after the monitor loop has been woken."""
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _watch_process(self, i, state):
+        """Register a pidfd for the camera's ffmpeg process with the selector.
+
+        Returns False if the process has to be polled instead because its
+        pidfd could not be opened.
+        """
+        if not self._use_pidfd or state.pidfd is not None:
+            return True
+        if state.pidfd_failed_pid == state.proc.pid:
+            return False
+        try:
+            state.pidfd = os.pidfd_open(state.proc.pid)
+        except OSError as e:
+            logger.warning(f"pidfd_open failed for camera {i} (PID: {state.proc.pid}), polling instead: {e}")
+            state.pidfd_failed_pid = state.proc.pid
+            return False
+        self._selector.register(state.pidfd, selectors.EVENT_READ, data=i)
+        return True
+
+    def _unwatch_process(self, state):
+        """Unregister and close the pidfd of an exited ffmpeg process."""
+        if state.pidfd is None:
+            return
+        self._selector.unregister(state.pidfd)
+        os.close(state.pidfd)
+        state.pidfd = None
+
+    def _wakeup(self):
+        """Wake the monitor loop from another thread."""
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def _get_video_devices(self, refresh=False):
+        """Return cached video device names in /dev, refreshing when stale."""
+        now = time.monotonic()
+        if refresh or self._video_devices_ts is None or now - self._video_devices_ts > VIDEO_DEVICES_TTL:
+            with os.scandir('/dev') as it:
+                self._video_devices = frozenset(e.name for e in it if e.name.startswith('video'))
+            self._video_devices_ts = now
+        return self._video_devices
 
     def test_camera_connection(self, ip, timeout=2):
         """Test if camera is reachable on RTMP port (1935)."""
@@ -58,54 +211,320 @@ class CameraStreamer:
             logger.error(f"Connection test to {ip}:1935 failed: {e}")
             return False
 
-    def test_stream(self, ip, user, password, stream_type, channel=0, stream_num=0, timeout=TEST_TIMEOUT):
-        """Test stream and extract resolution, FPS, and duplicate frames."""
-        rtmp_url = f"rtmp://{ip}/bcs/channel{channel}_{stream_type}.bcs?channel={channel}&stream={stream_num}&user={user}&password={password}"
+    @staticmethod
+    def _rtmp_url(cam, stream_type, channel=0):
+        """Build the RTMP URL for a camera stream from its cached template."""
+        return cam.url_tmpl.format(ch=channel, st=stream_type, sn=STREAM_NUM[stream_type])
+
+    def test_cameras_batch(self, ips, timeout=2):
+        """Test several cameras on RTMP port (1935) with one select() wait."""
+        results = {ip: False for ip in ips}
+        pending = {}
+        try:
+            for ip in results:
+                sock = None
+                try:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    err = sock.connect_ex((ip, 1935))
+                except Exception as e:
+                    logger.error(f"Connection test to {ip}:1935 failed: {e}")
+                    if sock:
+                        sock.close()
+                    continue
+                if err == errno.EINPROGRESS:
+                    pending[sock] = ip
+                else:
+                    results[ip] = err == 0
+                    sock.close()
+
+            deadline = time.monotonic() + timeout
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _, writable, _ = select.select([], list(pending), [], remaining)
+                for sock in writable:
+                    ip = pending.pop(sock)
+                    results[ip] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                    sock.close()
+        finally:
+            for sock in pending:
+                sock.close()
+        return results
+
+    def test_stream(self, cam, stream_type, timeout=TEST_TIMEOUT):
+        """Blocking wrapper around test_stream_async."""
+        return asyncio.run(self.test_stream_async(cam, stream_type, timeout=timeout))
+
+    async def _run_probe(self, cmd, timeout):
+        """Run a probe command, killing it on timeout, cancellation or shutdown."""
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        self._probe_procs.add(proc)
+        try:
+            if self._stop.is_set():
+                proc.kill()
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            proc.kill()
+            await proc.wait()
+            raise
+        finally:
+            self._probe_procs.discard(proc)
+        return proc.returncode, stdout, stderr
+
+    def _kill_probes(self):
+        """Kill in-flight probes so restart workers notice shutdown promptly."""
+        for proc in list(self._probe_procs):
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+
+    async def test_stream_async(self, cam, stream_type, timeout=TEST_TIMEOUT):
+        """Probe stream with ffprobe and extract resolution and FPS."""
+        ip = cam.ip
+        rtmp_url = self._rtmp_url(cam, stream_type)
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-analyzeduration', '1000000',  # 1s of stream analysis
+            '-probesize', '1000000',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=width,height,r_frame_rate,avg_frame_rate',
+            '-of', 'json',
+            '-rtmp_live', 'live',  # Same play mode as start_ffmpeg
+            rtmp_url
+        ]
+        try:
+            returncode, stdout, stderr = await self._run_probe(cmd, timeout)
+            if returncode != 0:
+                logger.warning(f"Stream test failed for {ip} with {stream_type} stream: {stderr.decode(errors='replace')}")
+                return False, None, None, 0
+            streams = _json_loads(stdout).get('streams')
+            if not streams:
+                logger.warning(f"Stream test failed for {ip} with {stream_type} stream: no video stream found")
+                return False, None, None, 0
+            width = int(streams[0].get('width', 0))
+            height = int(streams[0].get('height', 0))
+            # avg_frame_rate is 0/0 for some live streams; fall back to r_frame_rate
+            fps = (self._parse_frame_rate(streams[0].get('avg_frame_rate'))
+                   or self._parse_frame_rate(streams[0].get('r_frame_rate')))
+            resolution = f"{width}x{height}"
+            quality_score = width * height * fps
+            logger.info(f"Stream test succeeded for {ip} with {stream_type} stream: {resolution}@{fps}fps, score={quality_score}")
+            return True, resolution, fps, quality_score
+        except FileNotFoundError:
+            logger.warning("ffprobe not found. Falling back to ffmpeg stream test.")
+            return await self._test_stream_ffmpeg(ip, stream_type, rtmp_url, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stream test timed out for {ip} with {stream_type} stream")
+            return False, None, None, 0
+        except Exception as e:
+            logger.error(f"Stream test error for {ip} with {stream_type} stream: {e}")
+            return False, None, None, 0
+
+    @staticmethod
+    def _parse_frame_rate(rate):
+        """Convert an ffprobe "num/den" frame rate to FPS."""
+        try:
+            num, den = map(int, rate.split('/'))
+            return round(num / den, 3) if den else 0.0
+        except (AttributeError, ValueError):
+            return 0.0
+
+    async def _test_stream_ffmpeg(self, ip, stream_type, rtmp_url, timeout):
+        """Test stream by decoding with ffmpeg and parsing its stderr."""
         cmd = [
             'ffmpeg',
-            '-re',  # Real-time input
             '-rtmp_live', 'live',  # Force live streaming mode
+            '-fflags', 'nobuffer',  # Don't buffer input while probing
+            '-analyzeduration', '1000000',  # 1s of stream analysis
+            '-probesize', '1000000',
             '-i', rtmp_url,
-            '-t', '5',  # Short test duration
+            '-t', '1',  # Short test duration
             '-f', 'null', '-'  # Output to null
         ]
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
-            if result.returncode == 0:
+            returncode, _, stderr = await self._run_probe(cmd, timeout)
+            stderr = stderr.decode(errors='replace')
+            if returncode == 0:
                 # Parse resolution and FPS
-                resolution_match = re.search(r'(\d+x\d+)', result.stderr)
-                fps_match = re.search(r'(\d+\.?\d*) fps', result.stderr)
-                dup_match = re.search(r'dup=(\d+)', result.stderr)
+                resolution_match = _RES_RE.search(stderr)
+                fps_match = _FPS_RE.search(stderr)
                 resolution = resolution_match.group(1) if resolution_match else '0x0'
                 width, height = map(int, resolution.split('x')) if resolution != '0x0' else (0, 0)
                 fps = float(fps_match.group(1)) if fps_match else 0.0
-                dup_count = int(dup_match.group(1)) if dup_match else 0
-                quality_score = width * height * fps * (1 - dup_count / 1000)  # Penalize duplicates
-                logger.info(f"Stream test succeeded for {ip} with {stream_type} stream: {resolution}@{fps}fps, dup={dup_count}, score={quality_score}")
+                quality_score = width * height * fps
+                logger.info(f"Stream test succeeded for {ip} with {stream_type} stream: {resolution}@{fps}fps, score={quality_score}")
                 return True, resolution, fps, quality_score
             else:
-                logger.warning(f"Stream test failed for {ip} with {stream_type} stream: {result.stderr}")
+                logger.warning(f"Stream test failed for {ip} with {stream_type} stream: {stderr}")
                 return False, None, None, 0
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             logger.warning(f"Stream test timed out for {ip} with {stream_type} stream")
             return False, None, None, 0
         except Exception as e:
             logger.error(f"Stream test error for {ip} with {stream_type} stream: {e}")
             return False, None, None, 0
 
+    @staticmethod
+    def _is_camera_log(name):
+        return name.startswith('camera') and name.endswith('.log')
+
+    def _open_camera_logs(self):
+        """Open existing camera logs at EOF so only new output is followed."""
+        logs = {}
+        for name in filter(self._is_camera_log, os.listdir(LOG_DIR)):
+            f = logs[name] = open(os.path.join(LOG_DIR, name), 'rb')
+            f.seek(0, os.SEEK_END)
+        return logs
+
+    def _watch_error_logs(self, logs):
+        """Copy error lines appended to camera logs into ERROR_LOG."""
+        partial = {}
+        is_camera_log = self._is_camera_log
+
+        def drain(name):
+            path = os.path.join(LOG_DIR, name)
+            f = logs.get(name)
+            try:
+                st = os.stat(path)
+                if f is None or os.fstat(f.fileno()).st_ino != st.st_ino:
+                    # New or rotated log: read it from the beginning
+                    if f:
+                        f.close()
+                    f = logs[name] = open(path, 'rb')
+                    partial.pop(name, None)
+                elif st.st_size < f.tell():
+                    f.seek(0)
+                    partial.pop(name, None)
+                data = partial.pop(name, b'') + f.read()
+            except OSError:
+                return
+            # Hold back a trailing incomplete line until the rest is written
+            end = max(data.rfind(b'\n'), data.rfind(b'\r')) + 1
+            if end < len(data):
+                partial[name] = data[end:]
+            for line in data[:end].splitlines():
+                if _ERR_RE.search(line):
+                    self._err_fd.write(line + b'\n')
+
+        inotify = None
+        if INotify is not None:
+            inotify = INotify()
+            inotify.add_watch(LOG_DIR, inotify_flags.CREATE | inotify_flags.MODIFY)
+        else:
+            logger.warning("inotify_simple not installed. Polling camera logs for errors.")
+
+        try:
+            # Catch up on output written before the watch was set up
+            for name in filter(is_camera_log, os.listdir(LOG_DIR)):
+                drain(name)
+            while not self._stop.is_set():
+                if inotify:
+                    names = {event.name for event in inotify.read(timeout=1000)}
+                else:
+                    self._stop.wait(1)
+                    names = os.listdir(LOG_DIR)
+                for name in filter(is_camera_log, names):
+                    drain(name)
+        except Exception as e:
+            logger.error(f"Error log monitoring stopped: {e}")
+        finally:
+            for f in logs.values():
+                f.close()
+            if inotify:
+                inotify.close()
+
+    async def _probe_streams(self, cam, stream_types):
+        """Probe stream types concurrently, cancelling the rest once main works."""
+        tasks = {stream_type: asyncio.create_task(self.test_stream_async(cam, stream_type))
+                 for stream_type in stream_types}
+        results = {}
+        preferred = STREAM_TYPES[0]
+        if preferred in tasks:
+            results[preferred] = await tasks.pop(preferred)
+            success, _, _, quality_score = results[preferred]
+            if success and quality_score > 0:
+                # The preferred stream always wins; don't wait for the others
+                for task in tasks.values():
+                    task.cancel()
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
+                return results
+        for stream_type, task in tasks.items():
+            results[stream_type] = await task
+        return results
+
+    async def _probe_camera(self, cam, last_stream=None):
+        """Probe a camera's stream types, stopping early once a preferred one works.
+
+        If main worked last run it is tried on its own first. A lower stream that
+        worked last run is probed alongside main, so main can win it back. The
+        remaining stream types are only probed if none of these work.
+        """
+        preferred = STREAM_TYPES[0]
+        if last_stream == preferred:
+            first = [preferred]
+        elif last_stream in STREAM_TYPES:
+            first = [preferred, last_stream]
+        else:
+            first = STREAM_TYPES
+        results = await self._probe_streams(cam, first)
+        if any(success and quality_score > 0 for success, _, _, quality_score in results.values()):
+            return results
+        rest = [stream_type for stream_type in STREAM_TYPES if stream_type not in results]
+        if rest:
+            results.update(await self._probe_streams(cam, rest))
+        return results
+
+    async def _probe_all(self, candidates):
+        """Probe all cameras concurrently."""
+        results = await asyncio.gather(*(
+            self._probe_camera(cam, self._last_streams.get(str(i))) for i, cam in candidates
+        ))
+        return {i: result for (i, _), result in zip(candidates, results)}
+
+    def _load_last_streams(self):
+        """Load the last working stream type per camera index from STATE_FILE."""
+        try:
+            with open(STATE_FILE, 'rb') as f:
+                last_streams = _json_loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable stream state {STATE_FILE}: {e}")
+            return {}
+        if not isinstance(last_streams, dict):
+            logger.warning(f"Ignoring invalid stream state in {STATE_FILE}")
+            return {}
+        return {k: v for k, v in last_streams.items() if v in STREAM_TYPES}
+
+    def _remember_stream(self, i, stream_type):
+        """Record a working stream type and atomically rewrite STATE_FILE if it changed."""
+        with self._state_lock:
+            if self._last_streams.get(str(i)) == stream_type:
+                return
+            self._last_streams[str(i)] = stream_type
+            tmp_file = STATE_FILE + '.tmp'
+            try:
+                os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+                with open(tmp_file, 'w') as f:
+                    json.dump(self._last_streams, f)
+                os.replace(tmp_file, STATE_FILE)
+            except Exception as e:
+                logger.warning(f"Failed to save stream state to {STATE_FILE}: {e}")
+
     def start_ffmpeg(self, i, cam, stream_type, fps):
         """Start FFmpeg with optimized settings."""
-        ip = cam['ip']
-        user = cam.get('user', 'admin')
-        password = cam['password']
-        channel = 0
-        stream_num = 0 if stream_type in ['main', 'ext'] else 1
-
-        rtmp_url = f"rtmp://{ip}/bcs/channel{channel}_{stream_type}.bcs?channel={channel}&stream={stream_num}&user={user}&password={password}"
+        ip = cam.ip
+        rtmp_url = self._rtmp_url(cam, stream_type)
 
         log_file = os.path.join(LOG_DIR, f"camera{i}.log")
         cmd = [
-            'ffmpeg',
+            FFMPEG_BIN,
             '-re',  # Real-time input
             '-rtmp_live', 'live',  # Force live streaming mode
             '-i', rtmp_url,
@@ -118,7 +537,9 @@ class CameraStreamer:
 
         try:
             with open(log_file, 'a') as log:
-                proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+                # posix_spawn is only used with close_fds=False and no preexec_fn,
+                # process group or session; our own fds are non-inheritable anyway
+                proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, close_fds=False)
             logger.info(f"Started ffmpeg for camera {i} ({ip}) on /dev/video{i} with {stream_type} stream (PID: {proc.pid})")
             return proc
         except Exception as e:
@@ -132,17 +553,8 @@ class CameraStreamer:
             sys.exit(1)
 
         try:
-            with open(CAMERAS_CONFIG, 'r', encoding='utf-8-sig') as f:
-                content = f.read().strip()
-                if not content:
-                    logger.error(f"Config file {CAMERAS_CONFIG} is empty.")
-                    sys.exit(1)
-                logger.debug(f"First 10 chars of {CAMERAS_CONFIG}: {repr(content[:10])}")
-                cameras = json.loads(content)
-                if not cameras:
-                    logger.error(f"No cameras defined in {CAMERAS_CONFIG}.")
-                    sys.exit(1)
-                return cameras
+            st = os.stat(CAMERAS_CONFIG)
+            cameras = _load_cameras_cached(CAMERAS_CONFIG, st.st_mtime_ns, st.st_size)
         except json.JSONDecodeError as e:
             logger.error(f"Invalid JSON in {CAMERAS_CONFIG}: {e}")
             with open(CAMERAS_CONFIG, 'r', encoding='utf-8-sig') as f:
@@ -152,10 +564,100 @@ class CameraStreamer:
             logger.error(f"Failed to read {CAMERAS_CONFIG}: {e}")
             sys.exit(1)
 
+        if cameras is None:
+            logger.error(f"Config file {CAMERAS_CONFIG} is empty.")
+            sys.exit(1)
+        if not cameras:
+            logger.error(f"No cameras defined in {CAMERAS_CONFIG}.")
+            sys.exit(1)
+
+        # Validate entries once; invalid ones stay as None to keep /dev/video indexes
+        result = []
+        for i, raw in enumerate(cameras):
+            if not isinstance(raw, dict) or 'ip' not in raw or 'password' not in raw:
+                logger.error(f"Invalid camera config at index {i}: missing ip or password")
+                result.append(None)
+                continue
+            # JSON numbers (e.g. a numeric password) are accepted as strings
+            ip = str(raw['ip'])
+            user = str(raw.get('user', 'admin'))
+            password = str(raw['password'])
+            # Precompute the RTMP URL template with escaped credentials
+            url_tmpl = (
+                'rtmp://' + ip + '/bcs/channel{ch}_{st}.bcs?channel={ch}&stream={sn}'
+                + '&user=' + quote(user, safe='')
+                + '&password=' + quote(password, safe='')
+            )
+            result.append(Camera(ip=ip, password=password, user=user, url_tmpl=url_tmpl))
+        return result
+
+    def _restart_camera(self, i, state):
+        """Restart a failed camera, falling back through stream types."""
+        cam = state.cam
+        logger.warning(f"ffmpeg for camera {i} ({cam.ip}) with {STREAM_TYPES[state.fallback_index]} exited with code {state.proc.returncode}. Attempting fallback...")
+        next_index = (state.fallback_index + 1) % len(STREAM_TYPES)
+        retry_count = 0
+        best_stream = None
+        best_score = 0
+        best_resolution = None
+        best_fps = None
+
+        while retry_count < MAX_RETRIES:
+            if self._stop.is_set():
+                return
+            if f"video{i}" not in self._get_video_devices():
+                logger.error(f"/dev/video{i} no longer exists. Cannot restart camera {cam.ip}.")
+                break
+            if not self.test_camera_connection(cam.ip):
+                logger.error(f"Camera {cam.ip} is not reachable on port 1935. Retrying in {state.retry_delay}s...")
+                if self._stop.wait(state.retry_delay):
+                    return
+                state.retry_delay = min(state.retry_delay * 1.5, 30)
+                retry_count += 1
+                continue
+            next_stream = STREAM_TYPES[next_index]
+            success, resolution, fps, quality_score = self.test_stream(cam, next_stream)
+            if success and quality_score > best_score:
+                best_stream = next_stream
+                best_score = quality_score
+                best_resolution = resolution
+                best_fps = fps
+                if next_stream == STREAM_TYPES[0]:
+                    break  # Preferred stream works; no need to try the rest
+            next_index = (next_index + 1) % len(STREAM_TYPES)
+            retry_count += 1
+
+        if self._stop.is_set():
+            return
+        if best_stream:
+            logger.info(f"Selected {best_stream} stream for camera {cam.ip} ({best_resolution}@{best_fps}fps, score={best_score})")
+            new_proc = self.start_ffmpeg(i, cam, best_stream, best_fps)
+            if new_proc:
+                state.proc = new_proc
+                state.fallback_index = STREAM_TYPE_INDEX[best_stream]
+                state.retry_delay = 5
+                self._remember_stream(i, best_stream)
+                return
+        else:
+            logger.error(f"All streams failed for camera {cam.ip}. Retrying in {state.retry_delay}s...")
+        # Let the monitor loop schedule the next attempt
+        state.next_retry_at = time.monotonic() + state.retry_delay
+        state.retry_delay = min(state.retry_delay * 1.5, 30)
+
+    def _restart_worker(self, i, state):
+        """Run _restart_camera, then hand the camera back to the monitor loop."""
+        try:
+            self._restart_camera(i, state)
+        finally:
+            state.restarting = False
+            self._wakeup()
+
     def run(self):
         """Main loop to start and monitor FFmpeg processes."""
         os.makedirs(LOG_DIR, exist_ok=True)
-        open(ERROR_LOG, 'w').close()
+        if os.path.exists(ERROR_LOG):
+            os.truncate(ERROR_LOG, 0)
+        self._err_fd = open(ERROR_LOG, 'ab', buffering=0)
 
         # Run v4l2loopback setup script
         try:
@@ -169,47 +671,62 @@ class CameraStreamer:
             sys.exit(1)
 
         # Verify v4l2loopback devices
-        video_devices = [f for f in os.listdir('/dev') if f.startswith('video')]
+        video_devices = self._get_video_devices(refresh=True)
         if not video_devices:
             logger.error("No v4l2loopback devices found in /dev. Check module loading.")
             sys.exit(1)
-        logger.info(f"Found video devices: {', '.join(video_devices)}")
+        logger.info(f"Found video devices: {', '.join(sorted(video_devices))}")
+        logger.debug(f"ffmpeg binary: {FFMPEG_BIN}, posix_spawn available: {getattr(subprocess, '_USE_POSIX_SPAWN', False)}")
 
         # Load cameras config
         cameras = self.load_cameras_config()
 
-        # Start FFmpeg processes for reachable cameras
+        # Validate camera configs before probing
         camera_status = []
+        candidates = []
         for i, cam in enumerate(cameras):
             if i >= 16:
                 logger.warning("Maximum of 16 cameras supported. Ignoring additional cameras.")
                 break
-            if 'ip' not in cam or 'password' not in cam:
-                logger.error(f"Invalid camera config at index {i}: missing ip or password")
-                camera_status.append((i, cam['ip'], "skipped", "Invalid config"))
+            if cam is None:
+                camera_status.append((i, "unknown", "skipped", "Invalid config"))
                 continue
             if f"video{i}" not in video_devices:
-                logger.error(f"/dev/video{i} not found. Skipping camera {cam['ip']}.")
-                camera_status.append((i, cam['ip'], "skipped", "No v4l2 device"))
-                continue
-            if not self.test_camera_connection(cam['ip']):
-                logger.error(f"Camera {cam['ip']} is not reachable on port 1935. Skipping.")
-                camera_status.append((i, cam['ip'], "skipped", "Unreachable"))
+                logger.error(f"/dev/video{i} not found. Skipping camera {cam.ip}.")
+                camera_status.append((i, cam.ip, "skipped", "No v4l2 device"))
                 continue
+            candidates.append((i, cam))
+
+        # Check reachability of all cameras at once
+        reachable = self.test_cameras_batch([cam.ip for _, cam in candidates])
+        for i, cam in candidates:
+            if not reachable[cam.ip]:
+                logger.error(f"Camera {cam.ip} is not reachable on port 1935. Skipping.")
+                camera_status.append((i, cam.ip, "skipped", "Unreachable"))
+        candidates = [(i, cam) for i, cam in candidates if reachable[cam.ip]]
+
+        # Probe all cameras concurrently, trying last run's stream types first
+        self._last_streams = self._load_last_streams()
+        probe_results = asyncio.run(self._probe_all(candidates))
 
-            # Test all stream types and select the best based on quality
-            user = cam.get('user', 'admin')
-            password = cam['password']
+        # Start error log monitoring before any ffmpeg output is written
+        watcher = threading.Thread(
+            target=self._watch_error_logs, args=(self._open_camera_logs(),), name='error-log-watcher', daemon=True
+        )
+        watcher.start()
+
+        # Select the best stream per camera and start FFmpeg processes
+        for i, cam in candidates:
+            probes = probe_results[i]
             best_stream = None
             best_score = 0
             best_resolution = None
             best_fps = None
 
             for stream_type in STREAM_TYPES:
-                stream_num = 0 if stream_type in ['main', 'ext'] else 1
-                success, resolution, fps, quality_score = self.test_stream(
-                    cam['ip'], user, password, stream_type, channel=0, stream_num=stream_num
-                )
+                if stream_type not in probes:
+                    continue
+                success, resolution, fps, quality_score = probes[stream_type]
                 if success and quality_score > best_score:
                     best_stream = stream_type
                     best_score = quality_score
@@ -217,89 +734,74 @@ class CameraStreamer:
                     best_fps = fps
 
             if not best_stream:
-                logger.error(f"No valid stream (main, ext, sub) found for camera {cam['ip']}. Skipping.")
-                camera_status.append((i, cam['ip'], "skipped", "No valid stream"))
+                logger.error(f"No valid stream (main, ext, sub) found for camera {cam.ip}. Skipping.")
+                camera_status.append((i, cam.ip, "skipped", "No valid stream"))
                 continue
 
-            logger.info(f"Selected {best_stream} stream for camera {cam['ip']} ({best_resolution}@{best_fps}fps, score={best_score})")
+            logger.info(f"Selected {best_stream} stream for camera {cam.ip} ({best_resolution}@{best_fps}fps, score={best_score})")
             proc = self.start_ffmpeg(i, cam, best_stream, best_fps)
             if proc:
-                self.processes.append((i, cam, proc, STREAM_TYPES.index(best_stream)))
-                camera_status.append((i, cam['ip'], best_stream, f"{best_resolution}@{best_fps}fps"))
+                self.processes[i] = ProcState(cam, proc, STREAM_TYPE_INDEX[best_stream])
+                self._remember_stream(i, best_stream)
+                camera_status.append((i, cam.ip, best_stream, f"{best_resolution}@{best_fps}fps"))
             else:
-                camera_status.append((i, cam['ip'], "failed", "FFmpeg start failed"))
+                camera_status.append((i, cam.ip, "failed", "FFmpeg start failed"))
 
         # Log camera status summary
         logger.info("Camera setup summary:")
-        for i, ip, stream, status in camera_status:
+        for i, ip, stream, status in sorted(camera_status):
             logger.info(f"Camera {i} ({ip}): Stream={stream}, Status={status}")
 
-        # Start error log monitoring
-        subprocess.Popen([
-            'bash', '-c',
-            f'tail -f {os.path.join(LOG_DIR, "*.log")} | grep -iE "error|failed|timeout|connection refused|input/output error|end of file" >> {ERROR_LOG} &'
-        ])
-
-        # Monitor and restart FFmpeg processes with fallback
-        retry_delay = 5
-        while not self.exit_flag:
-            time.sleep(1)
-            for j, (i, cam, proc, fallback_index) in enumerate(self.processes):
-                if proc and proc.poll() is not None:
-                    logger.warning(f"ffmpeg for camera {i} ({cam['ip']}) with {STREAM_TYPES[fallback_index]} exited with code {proc.returncode}. Attempting fallback...")
-                    next_index = (fallback_index + 1) % len(STREAM_TYPES)
-                    retry_count = 0
-                    best_stream = None
-                    best_score = 0
-                    best_resolution = None
-                    best_fps = None
-
-                    while retry_count < MAX_RETRIES:
-                        if self.exit_flag:
-                            break
-                        if f"video{i}" not in [f for f in os.listdir('/dev') if f.startswith('video')]:
-                            logger.error(f"/dev/video{i} no longer exists. Cannot restart camera {cam['ip']}.")
-                            break
-                        if not self.test_camera_connection(cam['ip']):
-                            logger.error(f"Camera {cam['ip']} is not reachable on port 1935. Retrying in {retry_delay}s...")
-                            time.sleep(retry_delay)
-                            retry_delay = min(retry_delay * 1.5, 30)
-                            retry_count += 1
-                            continue
-                        next_stream = STREAM_TYPES[next_index]
-                        stream_num = 0 if next_stream in ['main', 'ext'] else 1
-                        user = cam.get('user', 'admin')
-                        password = cam['password']
-                        success, resolution, fps, quality_score = self.test_stream(
-                            cam['ip'], user, password, next_stream, channel=0, stream_num=stream_num
-                        )
-                        if success and quality_score > best_score:
-                            best_stream = next_stream
-                            best_score = quality_score
-                            best_resolution = resolution
-                            best_fps = fps
-                        next_index = (next_index + 1) % len(STREAM_TYPES)
-                        retry_count += 1
-
-                    if best_stream:
-                        logger.info(f"Selected {best_stream} stream for camera {cam['ip']} ({best_resolution}@{best_fps}fps, score={best_score})")
-                        new_proc = self.start_ffmpeg(i, cam, best_stream, best_fps)
-                        if new_proc:
-                            self.processes[j] = (i, cam, new_proc, STREAM_TYPES.index(best_stream))
-                            retry_delay = 5
-                    else:
-                        logger.error(f"All streams failed for camera {cam['ip']}. Retrying in {retry_delay}s...")
-                        time.sleep(retry_delay)
-                        retry_delay = min(retry_delay * 1.5, 30)
+        # Monitor FFmpeg processes and hand failed cameras to restart workers
+        exited = set(self.processes)  # Check every camera on the first pass
+        while not self._stop.is_set():
+            now = time.monotonic()
+            timeout = None
+            for i, state in self.processes.items():
+                if state.restarting:
+                    continue
+                if state.pidfd is not None and i not in exited:
+                    continue
+                if state.proc.poll() is None:
+                    if not self._watch_process(i, state):
+                        # No pidfd and no SIGCHLD handler to wake us, so poll
+                        timeout = 1.0 if timeout is None else min(timeout, 1.0)
+                    continue
+                self._unwatch_process(state)
+                if now < state.next_retry_at:
+                    wait = state.next_retry_at - now
+                    timeout = wait if timeout is None else min(timeout, wait)
+                    continue
+                state.restarting = True
+                state.worker = threading.Thread(
+                    target=self._restart_worker, args=(i, state), name=f'restart-camera{i}', daemon=True
+                )
+                state.worker.start()
+
+            exited = set()
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    self._drain_wakeup()
+                else:
+                    exited.add(key.data)
 
         logger.info("Cleaning up ffmpeg processes...")
-        for _, _, proc, _ in self.processes:
-            if proc and proc.poll() is None:
-                proc.terminate()
+        for state in self.processes.values():
+            if state.worker:
+                state.worker.join(timeout=TEST_TIMEOUT)
+        for state in self.processes.values():
+            if state.proc.poll() is None:
+                state.proc.terminate()
                 try:
-                    proc.wait(timeout=5)
+                    state.proc.wait(timeout=5)
                 except subprocess.TimeoutExpired:
-                    proc.kill()
+                    state.proc.kill()
+
+        for state in self.processes.values():
+            self._unwatch_process(state)
+        self._selector.close()
+        watcher.join(timeout=5)
+        self._err_fd.close()
 
 def main():
     streamer = CameraStreamer()